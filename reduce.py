@@ -1,23 +1,73 @@
 """Script for reducing images.
 
+Run with --watch to keep running during an observing night, reducing new
+frames as they arrive in dat/.
 """
+import argparse
+
 from fits_utils import *
 
-def main():
+#: path obj: Various folder locations.
+data_folder = Path("dat/")
+science_folder = Path("sci/")
+temp_folder = Path("tmp/")
+
+def get_settings():
     """
-    Grabs sorted lists of files from get_lists function. Creates a list of
-    possible integration times from the dark files. Combines darks and flats
-    into master HDUList objects. These objects are stored in dictionaries that
-    have the integration times or bands as the keys.
+    Reads the reduction settings from the config.ini file.
+
+    Returns:
+        settings (dict): Memory limit, cache size, number of workers, dtype,
+            flat estimators, compression and writing threads for the
+            reduction.
     """
-    # Generate the config file.
-    gen_config()
-    #: path obj: Various folder locations.
-    data_folder = Path("dat/")
-    science_folder = Path("sci/")
-    temp_folder = Path("tmp/")
-    #: list of dict: Lists contain dicts with filename (str) and other keys.
-    raw_dark_list, raw_flat_list, raw_target_list, raw_std_star_list = get_lists(data_folder)
+    #: ConfigParser: Contains reduction settings stored in .ini file.
+    config = configparser.ConfigParser()
+    config.read("config.ini")
+    reduction_settings = config["REDUCTION SETTINGS"]
+    return {
+        #: int: Memory budget in MB for combining calibration frames.
+        "memory_limit": reduction_settings.getint("memory limit"),
+        #: int: Size cap in MB for cached master frames in tmp/.
+        "cache_size": reduction_settings.getint("cache size"),
+        #: int: Number of processes used to reduce raw frames.
+        "workers": reduction_settings.getint("workers"),
+        #: dtype: Working dtype of the masters and science frames.
+        "dtype": np.dtype(reduction_settings["dtype"]),
+        #: dict of str: Flat normalisation estimator to use for each band.
+        "flat_estimators": dict((item.strip() for item in pair.split(":"))
+                                for pair in reduction_settings["flat estimators"].split(",")),
+        #: dict: Compression of the science frames in sci/, see write_out_fits.
+        "write_options": {
+            "compression": None if reduction_settings.get("compression", "none").lower() == "none"
+                           else reduction_settings["compression"],
+            "quantize_level": reduction_settings.getfloat("quantize level", 16),
+        },
+        #: int: Number of threads writing science frames in each process.
+        "io_threads": reduction_settings.getint("io threads", 2),
+        #: str: Lossless compression of the cached masters in tmp/.
+        "cache_compression": None if reduction_settings.get("cache compression", "none").lower() == "none"
+                             else reduction_settings["cache compression"],
+    }
+
+def create_masters(raw_dark_list, raw_flat_list, settings):
+    """
+    Creates a list of possible integration times from the dark files. Combines
+    darks and flats into master frames, reusing cached masters in tmp/ whose
+    inputs have not changed. The masters are stored in a dark library and a
+    dictionary that have the integration times or bands as the keys.
+
+    Args:
+        raw_dark_list (list of dict): Dark files, from get_lists.
+        raw_flat_list (list of dict): Flat files, from get_lists.
+        settings (dict): Reduction settings, from get_settings.
+    Returns:
+        dark_library (DarkLibrary): Master darks for any integration time.
+        master_flat_frame (dict of ndarray): Master flats keyed by band.
+    """
+    memory_limit = settings["memory_limit"]
+    cache_size = settings["cache_size"]
+    dtype = settings["dtype"]
     #: list of str: Contains possible integration times. No duplicates.
     possible_int_times = list(set(sub["integration_time"] for sub in raw_dark_list))
     #: list of str: Possible bands. No duplicates.
@@ -25,61 +75,130 @@ def main():
     #: dict of ndarray: Contains master dark objects and integration_times.
     print("Creating dark frames..."),
     master_dark_frame = {}
+    #: dict of str: Content keys of the master darks, used by the flats.
+    dark_keys = {}
     for pos_int_time in possible_int_times:
-        #: list of ndarray: Contains data of dark files.
-        sorted_dark_list = []
-        for dark in raw_dark_list:
-            if dark["integration_time"] == pos_int_time:
-                with fits.open(data_folder / dark["filename"]) as hdul:
-                    #: ndarray: image data
-                    data = hdul[0].data
-                    sorted_dark_list.append(data)
-        master_dark_frame[pos_int_time] = np.floor(np.median(sorted_dark_list, 0))
+        #: list of str: Filenames of dark files with this integration time.
+        sorted_dark_list = [dark["filename"] for dark in raw_dark_list if dark["integration_time"] == pos_int_time]
+        dark_params = dict(kind="dark", combine="median", floor=True, dtype=dtype)
+        dark_keys[pos_int_time] = fingerprint(sorted_dark_list, data_folder, **dark_params)
+        master_dark_frame[pos_int_time] = cached_master(
+            "dark_{}".format(pos_int_time), dark_keys[pos_int_time],
+            lambda: np.floor(median_combine(sorted_dark_list, data_folder, memory_limit=memory_limit, dtype=dtype)),
+            cache_dir=temp_folder, cache_size=cache_size,
+            compression=settings["cache_compression"], inputs=(sorted_dark_list, data_folder, dark_params))
+    #: DarkLibrary: Synthesises master darks for integration times without
+    #: darks of their own.
+    dark_library = DarkLibrary(master_dark_frame, dtype=dtype)
+    #: str: Content key of the dark library as a whole.
+    library_key = fingerprint([], data_folder, darks=sorted(dark_keys.values()))
+    # Find the hot pixels of the detector once, for use when aligning.
+    cached_master("hot_pixels", fingerprint([], data_folder, kind="hot_pixels", darks=library_key),
+                  lambda: hot_pixel_mask(dark_library).astype(np.uint8),
+                  cache_dir=temp_folder, cache_size=cache_size, compression=settings["cache_compression"])
     print("Done!")
     #: dict of ndarray: Master flat objects, bands, and integration times.
     print("Creating flat frames..."),
     master_flat_frame = {}
     for pos_band in possible_bands:
-        #: list of ndarray: Contains flat objects.
-        sorted_flat_list = []
-        for flat in raw_flat_list:
-            if flat["band"] == pos_band:
-                with fits.open(data_folder / flat["filename"]) as hdul:
-                    #: ndarray: dark subtracted image data
-                    data = np.subtract(hdul[0].data, master_dark_frame[flat["integration_time"]])
-                    sorted_flat_list.append(data)
-        master_flat_frame[pos_band] = normalise_flat(np.floor(np.median(sorted_flat_list, 0)))
+        #: list of dict: Contains flat files in this band.
+        sorted_flat_list = [flat for flat in raw_flat_list if flat["band"] == pos_band]
+        #: list of ndarray: Master darks to subtract from each flat.
+        flat_darks = [dark_library[flat["integration_time"]] for flat in sorted_flat_list]
+        #: list of str: Filenames of flat files in this band.
+        flat_filenames = [flat["filename"] for flat in sorted_flat_list]
+        #: str: Estimator of the flat level, see normalise_flat.
+        estimator = settings["flat_estimators"].get(pos_band, "histogram")
+        flat_params = dict(kind="flat", combine="median", floor=True, estimator=estimator, dtype=dtype,
+                           darks=sorted(set(dark_keys.get(flat["integration_time"], library_key) for flat in sorted_flat_list)))
+        flat_key = fingerprint(flat_filenames, data_folder, **flat_params)
+        master_flat_frame[pos_band] = cached_master(
+            "flat_{}".format(pos_band), flat_key,
+            lambda: normalise_flat(np.floor(median_combine(
+                flat_filenames, data_folder, subtract=flat_darks, memory_limit=memory_limit, dtype=dtype)),
+                estimator=estimator),
+            cache_dir=temp_folder, cache_size=cache_size,
+            compression=settings["cache_compression"], inputs=(flat_filenames, data_folder, flat_params))
     print("Done!")
+    return dark_library, master_flat_frame
 
-    #: dictionary of ndarray objects: Reduced target image list.
-    reduced_target_list = reduce_raws(raw_target_list, master_dark_frame, master_flat_frame, data_folder)
-    #: dictionary of ndarray objects: Reduced standard star image list.
-    reduced_std_star_list = reduce_raws(raw_std_star_list, master_dark_frame, master_flat_frame, data_folder)
+def main():
+    """
+    Grabs sorted lists of files from get_lists function, creates the master
+    darks and flats, and reduces every target and standard star frame into the
+    sci/ folder.
+    """
+    # Add any missing settings to the config file.
+    gen_config()
+    settings = get_settings()
+    #: list of dict: Lists contain dicts with filename (str) and other keys.
+    raw_dark_list, raw_flat_list, raw_target_list, raw_std_star_list = get_lists(data_folder)
+    dark_library, master_flat_frame = create_masters(raw_dark_list, raw_flat_list, settings)
 
-    print("Writing out dark frames..."),
-    for key, value in master_dark_frame.items():
-        write_out_fits(value, "tmp/dark_{}".format(key))
-    print("Done!")
-    print("Writing out flat frames..."),
-    for key, value in master_flat_frame.items():
-        write_out_fits(value, "tmp/flat_{}".format(key))
-    print("Done!")
+    # Reduce the raws in parallel, writing each science frame to sci/ as soon
+    # as it is done.
+    print("Reducing target images...")
+    reduce_raws(raw_target_list, dark_library, master_flat_frame, data_folder,
+                workers=settings["workers"], out_dir=science_folder, dtype=settings["dtype"],
+                write_options=settings["write_options"], io_threads=settings["io_threads"])
+    print("Reducing standard star images...")
+    reduce_raws(raw_std_star_list, dark_library, master_flat_frame, data_folder,
+                workers=settings["workers"], out_dir=science_folder, dtype=settings["dtype"],
+                write_options=settings["write_options"], io_threads=settings["io_threads"])
+
+def watch(interval=10):
+    """
+    Watches the dat/ folder for newly arrived frames and reduces them as they
+    come in. The folder is polled every interval seconds through its header
+    index, so each poll reads only the headers of new files. Frames already
+    in sci/ are not reduced again.
 
-    counter = 0
-    total = len(reduced_target_list)
-    for key, value in reduced_target_list.items():
-        counter += 1
-        print('Writing out {} of {} target images.'.format(counter, total), end='\r'),
-        write_out_fits(value, "sci/{}".format(key))
-    print("\nDone!")
+    Masters are recreated only when the calibration frames change, and then
+    only the masters whose integration time or band received new frames are
+    rebuilt; the others are taken from the cache in tmp/. A frame is reduced
+    once it has not been modified for a full interval, so that files still
+    being written by the camera are left until the next poll.
 
-    counter = 0
-    total = len(reduced_std_star_list)
-    for key, value in reduced_std_star_list.items():
-        counter += 1
-        print("Writing out {} of {} standard star images...".format(counter, total), end="\r"),
-        write_out_fits(value, "sci/{}".format(key))
-    print("\nDone!")
+    Args:
+        interval (float): Seconds between polls of dat/. Defaults to 10.
+    """
+    gen_config()
+    settings = get_settings()
+    calibration_state = None
+    science_folder.mkdir(exist_ok=True)
+    reduced = set(path.name for path in science_folder.glob("*.fits"))
+    print("Watching {} for new frames. Press Ctrl+C to stop.".format(data_folder))
+    try:
+        while True:
+            now = time.time_ns()
+            settled = {row["filename"] for row in query_index(data_folder) if now - row["mtime"] > interval * 1e9}
+            raw_dark_list, raw_flat_list, raw_target_list, raw_std_star_list = get_lists(data_folder)
+            raw_dark_list = [dark for dark in raw_dark_list if dark["filename"] in settled]
+            raw_flat_list = [flat for flat in raw_flat_list if flat["filename"] in settled]
+            new_raws = [raw for raw in raw_target_list + raw_std_star_list
+                        if raw["filename"] in settled and raw["filename"] not in reduced]
+            # Recreate the masters only if the calibration frames have changed.
+            new_state = fingerprint([raw["filename"] for raw in raw_dark_list + raw_flat_list], data_folder)
+            if new_state != calibration_state and raw_dark_list and raw_flat_list:
+                dark_library, master_flat_frame = create_masters(raw_dark_list, raw_flat_list, settings)
+                calibration_state = new_state
+            if new_raws and calibration_state is not None:
+                print("Reducing {} new images...".format(len(new_raws)))
+                reduce_raws(new_raws, dark_library, master_flat_frame, data_folder,
+                            workers=min(settings["workers"], len(new_raws)),
+                            out_dir=science_folder, dtype=settings["dtype"],
+                            write_options=settings["write_options"], io_threads=settings["io_threads"])
+                reduced.update(raw["filename"] for raw in new_raws)
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print("\nStopped watching.")
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description="Reduce raw frames in dat/ into science frames in sci/.")
+    parser.add_argument("--watch", action="store_true", help="keep reducing new frames as they arrive")
+    parser.add_argument("--interval", type=float, default=10, help="seconds between polls in watch mode")
+    args = parser.parse_args()
+    if args.watch:
+        watch(args.interval)
+    else:
+        main()
@@ -1,21 +1,199 @@
 """
 Script to align and stack images.
+
+Each (target, band) stack is an independent job, and the jobs are run on a
+pool of processes, as many at once as the memory limit in config.ini allows.
+Summed stacks are written with their running sums and table of frames, see
+update_stack. Run with --incremental to add only the frames that have arrived
+in sci/ since the stacks in sta/ were last written, rather than restacking.
+Stacks with a robust combine method, such as "sigma_clip" to reject satellite
+trails and cosmic rays, are combined in tiles by tile_stack and are always
+restacked in full, as they have no running sums to add to.
 """
+import argparse
+from concurrent.futures import wait, FIRST_COMPLETED
+
 from fits_utils import *
 
-def main():
-    for target in ["m52"]:
-        for band in ["r", "g"]:
-            unaligned_images = load_fits(path="sci/", target=target, band=band)
-            aligned_images = align(unaligned_images, centroid=hybrid_centroid, filter="none")
-            stacked_image = stack(aligned_images, correct_exposure=True)
-            write_out_fits(stacked_image, "sta/{}_{}_stacked.fits".format(target, band))
-    for target in ["m52"]:
-        for band in ["u"]:
-            unaligned_images = load_fits(path="sci/", target=target, band=band)
-            aligned_images = align(unaligned_images, centroid=hybrid_centroid, filter="combined")
-            stacked_image = stack(aligned_images, correct_exposure=True)
-            write_out_fits(stacked_image, "sta/{}_{}_stacked.fits".format(target, band))
+#: path obj: Various folder locations.
+science_folder = Path("sci/")
+stacked_folder = Path("sta/")
+temp_folder = Path("tmp/")
+
+#: dict: Settings shared by the stacks of every band. "combine" is "sum", or a
+#: robust combine method of tile_stack, e.g. "median", "sigma_clip" or
+#: "winsorised", with its further arguments under "combine_options".
+common_settings = {"interpolation": "lanczos3", "weighting": "ivar", "combine": "sum",
+                   "combine_options": {"memory_limit": 1024}}
+
+#: dict of dict: Registration and combine settings of each band, overriding
+#: common_settings. A "bad_pixels" value of "hot" is replaced by the cached
+#: hot pixel mask.
+band_settings = {
+    "g": {"method": "fft"},
+    "r": {"method": "fft"},
+    "u": {"method": "centroid", "centroid": hybrid_centroid, "filter": "combined",
+          "search": "pyramid", "bad_pixels": "hot"},
+}
+
+def get_settings():
+    """
+    Reads the targets, bands and stacking settings from the config.ini file.
+
+    Returns:
+        settings (dict): Targets, bands, memory limit, number of workers,
+            compression, output dtype and writing threads for stacking.
+    """
+    #: ConfigParser: Contains stacking settings stored in .ini file.
+    config = configparser.ConfigParser()
+    config.read("config.ini")
+    compression = config.get("STACKING SETTINGS", "compression", fallback="none")
+    return {
+        #: list of str: Targets to stack.
+        "targets": [target.strip() for target in config.get("DATA SETTINGS", "target id", fallback="m52").split(",")],
+        #: list of str: Bands to stack.
+        "bands": [band.strip() for band in config.get("DATA SETTINGS", "bands", fallback="g, r, u").split(",")],
+        #: int: Memory budget in MB shared by the stacking jobs.
+        "memory_limit": config.getint("STACKING SETTINGS", "memory limit", fallback=4096),
+        #: int: Number of processes stacking at once.
+        "workers": config.getint("STACKING SETTINGS", "workers", fallback=4),
+        #: dict: Compression of the stacks in sta/, see write_out_fits.
+        "write_options": {
+            "compression": None if compression.lower() == "none" else compression,
+            "quantize_level": config.getfloat("STACKING SETTINGS", "quantize level", fallback=16),
+            "dtype": np.dtype(config.get("STACKING SETTINGS", "dtype", fallback="float32")),
+        },
+        #: int: Number of threads writing stacks in each process.
+        "io_threads": config.getint("STACKING SETTINGS", "io threads", fallback=2),
+    }
+
+def estimate_memory(frames, settings):
+    """
+    Estimates the peak memory of stacking a set of frames, in MB, as the
+    larger of the working sets of registration and of stacking, which do not
+    overlap. Both depend on the area of a frame, not on the number of frames.
+
+    Registration by "fft" holds the reference and a batch of frames, with the
+    complex spectra and correlation surfaces of the binned frames. The
+    "centroid" method holds a frame and its smoothed, masked copies in each
+    thread, and "asterism" one frame and its filtered copies. A summed stack
+    holds its buffers and the working copies of the frame being shifted, and a
+    robust stack its output buffers and the memory budget of tile_stack.
+
+    Args:
+        frames (list of Frame): Frames to be stacked.
+        settings (dict): Settings of the stack, see band_settings.
+    Returns:
+        memory (float): Estimated peak memory in MB.
+    """
+    rows, cols = frame_shape(frames[0])
+    #: float: Size in MB of a frame as float64.
+    area = rows * cols * np.dtype(float).itemsize / 1024**2
+    method = settings.get("method", "centroid")
+    if method == "fft":
+        batch, factor = settings.get("batch", 4), settings.get("bin", 4)
+        registration = (1 + batch) * area + 6 * (1 + batch) * area / factor**2
+    elif method == "asterism":
+        registration = 4 * area
+    else:
+        registration = 4 * settings.get("workers", 4) * area
+    if settings.get("combine", "sum") != "sum":
+        stacking = 3 * area + settings.get("combine_options", {}).get("memory_limit", 1024)
+    else:
+        stacking = 12 * area
+    return max(registration, stacking)
+
+def stack_job(target, band, incremental=False, write_options={}, io_threads=2):
+    """
+    Registers and stacks the frames of one target in one band, and queues the
+    stack to be written to sta/ by the background writer of the process, so
+    that the next job can start while it is written. Run in a worker process.
+
+    Args:
+        target (str): Target ID.
+        band (str): Observing band.
+        incremental (bool): Whether to add only new frames to an existing
+            summed stack, rather than restacking every frame, see
+            update_stack. Robust stacks are always restacked.
+        write_options (dict): Options for writing the stack, see
+            write_out_fits.
+        io_threads (int): Number of writing threads of the process.
+    Returns:
+        filename (Path): The stack to be written, or None if it was up to
+            date.
+    """
+    writer = process_writer(workers=io_threads, queue_size=io_threads)
+    settings = dict(common_settings, **band_settings.get(band, {}))
+    if isinstance(settings.get("bad_pixels"), str) and settings["bad_pixels"] == "hot":
+        settings["bad_pixels"] = load_hot_pixel_mask(temp_folder)
+    filename = stacked_folder / "{}_{}_stacked.fits".format(target, band)
+    combine = settings.pop("combine", "sum")
+    combine_options = settings.pop("combine_options", {})
+    if combine != "sum":
+        if incremental:
+            print("{} is combined by {}, restacking it in full.".format(filename, combine))
+        stacked_image = stream_stack(path=science_folder, target=target, band=band, combine=combine,
+                                     combine_options=combine_options, **settings)
+        if stacked_image is None:
+            return None
+        writer.write(stacked_image, filename, **write_options)
+        return filename
+    stacked_image = update_stack(filename, path=science_folder, target=target, band=band, restack=not incremental,
+                                 write_options=write_options, writer=writer, **settings)
+    return filename if stacked_image is not None else None
+
+def main(incremental=False):
+    """
+    Schedules a stacking job for every target and band with frames in sci/.
+    Jobs are started while the estimated memory of the running jobs stays
+    within the memory limit, and at least one job always runs. The stacks are
+    written in the background by each worker, and are all on disk once the
+    pool has shut down.
+
+    Args:
+        incremental (bool): Whether to add only new frames to the existing
+            stacks.
+    """
+    settings = get_settings()
+    stacked_folder.mkdir(exist_ok=True)
+    jobs = []
+    for target in settings["targets"]:
+        for band in settings["bands"]:
+            frames = load_fits(path=science_folder, target=target, band=band)
+            if frames:
+                jobs.append((estimate_memory(frames, dict(common_settings, **band_settings.get(band, {}))),
+                             target, band))
+            else:
+                print("No {} frames of {} to stack.".format(band, target))
+    # Start with the largest jobs, so that small ones fill the gaps.
+    jobs.sort(reverse=True)
+    running = {}
+    filenames = []
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=settings["workers"]) as executor:
+        while jobs or running:
+            in_use = sum(memory for memory, _, _ in running.values())
+            while jobs and len(running) < settings["workers"] and \
+                    (not running or in_use + jobs[0][0] <= settings["memory_limit"]):
+                memory, target, band = jobs.pop(0)
+                running[executor.submit(stack_job, target, band, incremental, settings["write_options"],
+                                        settings["io_threads"])] = (memory, target, band)
+                in_use += memory
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                _, target, band = running.pop(future)
+                filename = future.result()
+                if filename is not None:
+                    filenames.append(filename)
+                    print("Stacked {} {} into {}".format(target, band, filename))
+    # The writers of the workers are flushed as the pool shuts down, so any
+    # stack that failed to write is missing or out of date now.
+    missing = unwritten(filenames, start)
+    if missing:
+        raise OSError("Failed to write {} stacks, e.g. {}.".format(len(missing), missing[0]))
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description="Align and stack science frames in sci/ into sta/.")
+    parser.add_argument("--incremental", action="store_true", help="add only new frames to the existing stacks")
+    args = parser.parse_args()
+    main(args.incremental)